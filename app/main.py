@@ -1,10 +1,54 @@
-from fastapi import FastAPI, HTTPException, BackgroundTasks
+import asyncio
+import collections
+import logging
+import multiprocessing
+import operator
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
+from functools import partial
+
+import anyio.to_thread
+import orjson
+from fastapi import FastAPI, HTTPException, Query, WebSocket
+from fastapi.responses import Response
 from pydantic import BaseModel
 import serial
 import serial.tools.list_ports
 from pymavlink import mavutil  # Import pymavlink for MAVLink protocol
 
-app = FastAPI()
+logger = logging.getLogger(__name__)
+
+@asynccontextmanager
+async def lifespan(app):
+    """
+    Own the CPU process pool and close any drone connection on shutdown.
+    """
+    # Spawn rather than fork: worker threads may be holding mavlink_read_lock
+    app.state.cpu_pool = ProcessPoolExecutor(
+        max_workers=os.cpu_count(),
+        mp_context=multiprocessing.get_context("spawn"),
+    )
+    try:
+        yield
+    finally:
+        async with app.state.lock:
+            await close_drone_connection()
+        app.state.cpu_pool.shutdown(cancel_futures=True)
+
+app = FastAPI(lifespan=lifespan)
+
+# Connection state; open/close are serialized by app.state.lock, while read
+# paths snapshot the attribute they need into a local without locking
+app.state.mav = None  # MAVLink connection object; it owns the serial port
+app.state.mode_map = {}  # Flight mode name -> mode id for the connected autopilot
+app.state.command_long = None  # command_long_send bound to the vehicle's ids
+app.state.telemetry_task = None
+app.state.link_down = False  # Set by the pump while it is retrying after a serial error
+app.state.latest_telemetry = None  # (ring entry, encoded /telemetry body) for the newest message
+app.state.lock = asyncio.Lock()
 
 # Model for selecting communication parameters
 class CommunicationConfig(BaseModel):
@@ -15,77 +59,404 @@ class CommunicationConfig(BaseModel):
 class DroneMode(BaseModel):
     mode_name: str
 
-# Serial connection object (global)
-ser = None
-mav_connection = None  # MAVLink connection object
+# Model for sending a MAV_CMD_DO_SET_MODE command
+class DroneCommand(BaseModel):
+    mode_id: int
+    confirmation: int = 0
+
+# Ring buffer of recent telemetry as (msg_type, time_boot_ms, fieldnames, values)
+TELEMETRY_RING_SIZE = 4096
+TELEMETRY_RING = collections.deque(maxlen=TELEMETRY_RING_SIZE)
+
+# Bounded per-subscriber queues fed by the background pump
+TELEMETRY_QUEUE_SIZE = 256
+telemetry_subscribers = set()
+
+# Seconds /connect_drone waits for the first heartbeat; app.state.lock is held meanwhile
+HEARTBEAT_TIMEOUT = 5.0
+
+# Held by the worker thread while it reads, so a connection is never closed mid-read
+mavlink_read_lock = threading.Lock()
+
+async def run_blocking(func, *args, **kwargs):
+    """
+    Run a blocking pymavlink/serial call on the anyio worker thread pool.
+
+    This is the same limiter FastAPI uses for sync endpoints, so the pool size
+    is governed by anyio.to_thread.current_default_thread_limiter().total_tokens.
+    """
+    return await anyio.to_thread.run_sync(partial(func, *args, **kwargs))
+
+async def run_cpu_bound(func, payload):
+    """
+    Run a CPU-heavy transform in the process pool so it bypasses the GIL.
+
+    func must be a picklable module-level function; pass the payload as
+    orjson-encoded bytes to keep pickling cheap.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(app.state.cpu_pool, func, payload)
+
+def publish_telemetry(item):
+    """
+    Publish a telemetry item to every subscriber, dropping their oldest item when full.
+    """
+    for queue in telemetry_subscribers:
+        if queue.full():
+            queue.get_nowait()
+        queue.put_nowait(item)
+
+async def iter_telemetry():
+    """
+    Subscribe to the telemetry pump and yield items as they are published.
+    """
+    queue = asyncio.Queue(maxsize=TELEMETRY_QUEUE_SIZE)
+    telemetry_subscribers.add(queue)
+    try:
+        while True:
+            yield await queue.get()
+    finally:
+        telemetry_subscribers.discard(queue)
+
+def fields_getter(fieldnames):
+    """
+    Build a callable that extracts the given fields from a message as a tuple.
+    """
+    if not fieldnames:
+        return lambda msg: ()
+    if len(fieldnames) == 1:
+        getter = operator.attrgetter(fieldnames[0])
+        return lambda msg: (getter(msg),)
+    return operator.attrgetter(*fieldnames)
+
+# Message type -> (fieldnames, tuple getter), precomputed from the dialect
+FIELD_GETTERS = {
+    cls.msgname: (cls.fieldnames, fields_getter(cls.fieldnames))
+    for cls in mavutil.mavlink.mavlink_map.values()
+}
+
+def record_message(msg, msg_type):
+    """
+    Store a telemetry message in the ring and publish it to stream subscribers.
+    """
+    getters = FIELD_GETTERS.get(msg_type)
+    if getters is None:
+        fieldnames = msg.get_fieldnames()
+        getters = (fieldnames, fields_getter(fieldnames))
+        # Cache only dialect messages (e.g. after a v2 switch), never noise-made UNKNOWN_<id> types
+        if msg.get_msgId() in mavutil.mavlink.mavlink_map:
+            FIELD_GETTERS[msg_type] = getters
+    fieldnames, get_values = getters
+    entry = (msg_type, getattr(msg, "time_boot_ms", None), fieldnames, get_values(msg))
+    TELEMETRY_RING.append(entry)
+
+    # Only encode when someone is streaming; all subscribers share the bytes
+    if telemetry_subscribers:
+        publish_telemetry(dump_json(telemetry_record(entry)))
+
+def ignore_message(msg, msg_type):
+    """
+    Drop messages that should not reach telemetry consumers.
+    """
+
+# Per-message-type telemetry handlers; anything not listed is recorded as-is
+TELEMETRY_HANDLERS = {
+    "BAD_DATA": ignore_message,
+}
+
+# Serial read sizing: OS driver buffers (Windows only) and bytes per read() call
+SERIAL_RX_BUFFER_SIZE = 1 << 20
+SERIAL_TX_BUFFER_SIZE = 1 << 16
+SERIAL_READ_CHUNK = 4096
+
+def tune_serial_port(connection):
+    """
+    Make a serial MAVLink connection read in large chunks instead of per-packet slices.
+
+    mavserial asks the port for only bytes_needed() bytes at a time. Its port
+    is non-blocking (timeout=0), so reading a whole chunk returns whatever is
+    buffered and lets the parser consume it in one pass.
+    """
+    if not isinstance(connection, mavutil.mavserial):
+        return
+    port = connection.port
+    if hasattr(port, "set_buffer_size"):
+        port.set_buffer_size(rx_size=SERIAL_RX_BUFFER_SIZE, tx_size=SERIAL_TX_BUFFER_SIZE)
+    # Look the port up on each call; mavserial.reset() swaps in a new one
+    connection.recv = lambda n=None: connection.port.read(max(n or 0, SERIAL_READ_CHUNK))
+
+# Upper bound on messages drained per worker-thread hop
+MAX_READ_BATCH = 256
+
+def read_messages(connection):
+    """
+    Wait up to half a second for a MAVLink message, then drain whatever else is buffered.
+    """
+    recv = connection.recv_match
+    with mavlink_read_lock:
+        msg = recv(blocking=True, timeout=0.5)
+        if msg is None:
+            return []
+        batch = [msg]
+        append = batch.append
+        for _ in range(MAX_READ_BATCH - 1):
+            msg = recv(blocking=False)
+            if msg is None:
+                break
+            append(msg)
+        return batch
+
+def close_connection(connection):
+    """
+    Close a MAVLink connection once no read is in progress on it.
+    """
+    with mavlink_read_lock:
+        connection.close()
+
+def reopen_connection(connection):
+    """
+    Reopen the serial device behind a MAVLink connection after an I/O error.
+    """
+    if not isinstance(connection, mavutil.mavserial):
+        return
+    with mavlink_read_lock:
+        connection.reset()
+    tune_serial_port(connection)
+
+# Reconnect delays after serial errors, doubling up to the maximum
+RECONNECT_BACKOFF_INITIAL = 0.25
+RECONNECT_BACKOFF_MAX = 5.0
+
+async def pump_telemetry(connection):
+    """
+    Single reader of the MAVLink stream; feeds the telemetry ring and queue.
+
+    The connection is opened once by /connect_drone and reused for the
+    lifetime of the pump. Serial errors (e.g. an unplugged radio) are retried
+    with exponential backoff; the backoff resets once a heartbeat arrives.
+    app.state.link_down is set from the first error until messages flow again.
+    """
+    backoff = RECONNECT_BACKOFF_INITIAL
+    # Bound once; the loop below runs for every message received
+    get_handler = TELEMETRY_HANDLERS.get
+    while True:
+        try:
+            batch = await run_blocking(read_messages, connection)
+        except (serial.SerialException, OSError):
+            if not app.state.link_down:
+                logger.exception("Telemetry link lost; reconnecting")
+            app.state.link_down = True
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, RECONNECT_BACKOFF_MAX)
+            try:
+                await run_blocking(reopen_connection, connection)
+            except (serial.SerialException, OSError) as e:
+                logger.warning("Reconnect failed, retrying in %gs: %s", backoff, e)
+            continue
+
+        if batch and app.state.link_down:
+            logger.info("Telemetry link restored")
+            app.state.link_down = False
 
-# Placeholder for real-time telemetry data
-telemetry_data = {}
+        for msg in batch:
+            msg_type = msg.get_type()
+            if msg_type == "HEARTBEAT":
+                backoff = RECONNECT_BACKOFF_INITIAL
+            handler = get_handler(msg_type)
+            if handler is None:
+                # Unknown ids skip pymavlink's CRC check, so they are mostly line noise
+                handler = ignore_message if msg_type.startswith("UNKNOWN_") else record_message
+            try:
+                handler(msg, msg_type)
+            except Exception:
+                logger.exception("Failed to handle %s telemetry message", msg_type)
+
+def telemetry_pump_done(task):
+    """
+    Log a telemetry pump that died and drop its stale telemetry.
+    """
+    if task.cancelled() or task.exception() is None:
+        return
+    logger.error("Telemetry pump stopped", exc_info=task.exception())
+    if app.state.telemetry_task is task:
+        app.state.latest_telemetry = None
+        TELEMETRY_RING.clear()
+
+def json_default(value):
+    """
+    Encode raw byte fields, which orjson does not handle, as hex strings.
+    """
+    if isinstance(value, (bytes, bytearray)):
+        return value.hex()
+    raise TypeError
+
+def dump_json(obj):
+    """
+    Serialize telemetry with orjson.
+    """
+    return orjson.dumps(obj, default=json_default)
+
+def telemetry_record(entry):
+    """
+    Expand a ring buffer entry into a JSON-friendly telemetry record.
+    """
+    msg_type, time_boot_ms, fieldnames, values = entry
+    return {"type": msg_type, "time_boot_ms": time_boot_ms, "fields": dict(zip(fieldnames, values))}
+
+async def close_drone_connection():
+    """
+    Stop the telemetry pump and close the current connection; caller holds app.state.lock.
+    """
+    task = app.state.telemetry_task
+    if task:
+        task.cancel()
+        try:
+            await task
+        except (asyncio.CancelledError, Exception):
+            pass
+        app.state.telemetry_task = None
+
+    mav = app.state.mav
+    app.state.mav = None
+    app.state.mode_map = {}
+    app.state.command_long = None
+    app.state.link_down = False
+    app.state.latest_telemetry = None
+    TELEMETRY_RING.clear()
+    if mav:
+        await run_blocking(close_connection, mav)
+
+# Port enumeration walks the registry or /sys, so results are reused briefly
+COM_PORTS_TTL = 2.0
+com_ports_cache = (float("-inf"), [])  # (monotonic timestamp, ports)
 
 @app.get("/com_ports", tags=["Communication"])
 def list_com_ports():
     """
     List all available COM ports on the system.
     """
-    ports = serial.tools.list_ports.comports()
+    global com_ports_cache
+    cached_at, ports = com_ports_cache
+    if time.monotonic() - cached_at >= COM_PORTS_TTL:
+        ports = serial.tools.list_ports.comports()
+        com_ports_cache = (time.monotonic(), ports)
     if not ports:
         return {"message": "No COM ports found."}
     return {"ports": [port.device for port in ports]}
 
 @app.post("/connect_drone", tags=["Communication"])
-def connect_drone(config: CommunicationConfig, background_tasks: BackgroundTasks):
+async def connect_drone(config: CommunicationConfig):
     """
     Establish a connection with the drone via the selected COM port and baud rate.
     """
-    global ser, mav_connection
-    try:
-        # Close any existing connections
-        if ser and ser.is_open:
-            ser.close()
-        
-        # Open a new serial connection
-        ser = serial.Serial(port=config.port, baudrate=config.baud_rate, timeout=1)
-        mav_connection = mavutil.mavlink_connection(config.port, baud=config.baud_rate)
-        
-        # Wait for the heartbeat to ensure communication
-        mav_connection.wait_heartbeat()
-        
-        return {"message": f"Connected to {config.port} at {config.baud_rate} bps"}
-    
-    except serial.SerialException as e:
-        raise HTTPException(status_code=500, detail=f"Connection error: {e}")
+    async with app.state.lock:
+        try:
+            # Stop the previous telemetry reader and close any existing connections
+            await close_drone_connection()
+
+            # Open the serial port through pymavlink, which owns the only descriptor
+            mav = await run_blocking(mavutil.mavlink_connection, config.port, baud=config.baud_rate)
+            tune_serial_port(mav)
+
+            # Wait for the heartbeat to ensure communication
+            try:
+                heartbeat = await run_blocking(mav.wait_heartbeat, timeout=HEARTBEAT_TIMEOUT)
+            except BaseException:
+                await run_blocking(close_connection, mav)
+                raise
+            if heartbeat is None:
+                await run_blocking(close_connection, mav)
+                raise HTTPException(
+                    status_code=504,
+                    detail=f"No heartbeat from {config.port} within {HEARTBEAT_TIMEOUT:g}s",
+                )
+
+            # The mode table depends on the autopilot type, which is known after the heartbeat
+            app.state.mode_map = mav.mode_mapping() or {}
+
+            # Resolve the target ids reported by the heartbeat once, not per command
+            app.state.command_long = partial(
+                mav.mav.command_long_send,
+                mav.target_system,
+                mav.target_component,
+            )
+
+            # Start the single background reader for telemetry
+            app.state.telemetry_task = asyncio.create_task(pump_telemetry(mav))
+            app.state.telemetry_task.add_done_callback(telemetry_pump_done)
+            app.state.mav = mav
+
+            return {"message": f"Connected to {config.port} at {config.baud_rate} bps"}
+
+        except serial.SerialException as e:
+            raise HTTPException(status_code=500, detail=f"Connection error: {e}")
 
 @app.get("/telemetry", tags=["Communication"])
-def get_telemetry():
+async def get_telemetry(limit: int = Query(1, ge=1, le=TELEMETRY_RING_SIZE)):
     """
-    Get real-time telemetry data from the drone.
+    Get the most recent telemetry messages received from the drone, oldest first.
     """
-    global mav_connection
-    if not mav_connection:
+    if not app.state.mav:
         raise HTTPException(status_code=500, detail="No MAVLink connection established.")
-    
-    try:
-        msg = mav_connection.recv_match(blocking=True)
-        if msg:
-            return {"telemetry": msg.to_dict()}
-        else:
+    task = app.state.telemetry_task
+    if task is None or task.done():
+        raise HTTPException(status_code=503, detail="Telemetry reader has stopped; reconnect the drone.")
+    if app.state.link_down:
+        raise HTTPException(status_code=503, detail="Telemetry link is down; reconnecting.")
+    if limit == 1:
+        if not TELEMETRY_RING:
             raise HTTPException(status_code=404, detail="No telemetry data available.")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error fetching telemetry: {e}")
+        # Encode the newest entry on first read and reuse it until a newer one arrives
+        entry = TELEMETRY_RING[-1]
+        latest = app.state.latest_telemetry
+        if latest is None or latest[0] is not entry:
+            body = b'{"telemetry":[' + dump_json(telemetry_record(entry)) + b"]}"
+            latest = app.state.latest_telemetry = (entry, body)
+        return Response(content=latest[1], media_type="application/json")
+    # list() takes a consistent snapshot of the ring before slicing
+    snapshot = list(TELEMETRY_RING)[-limit:]
+    if not snapshot:
+        raise HTTPException(status_code=404, detail="No telemetry data available.")
+    body = dump_json({"telemetry": [telemetry_record(entry) for entry in snapshot]})
+    return Response(content=body, media_type="application/json")
+
+@app.websocket("/telemetry/stream")
+async def stream_telemetry(websocket: WebSocket):
+    """
+    Push each telemetry message to the client as soon as it is received.
+    """
+    await websocket.accept()
+
+    async def send_records():
+        async for record in iter_telemetry():
+            await websocket.send_text(record.decode())
+
+    # Sending happens in its own task so a disconnect is noticed right away,
+    # not on the next send; cancelling it unsubscribes its queue
+    sender = asyncio.create_task(send_records())
+    try:
+        while (await websocket.receive())["type"] != "websocket.disconnect":
+            pass
+    finally:
+        sender.cancel()
+        try:
+            await sender
+        except (asyncio.CancelledError, Exception):
+            pass
 
 @app.post("/change_mode", tags=["Communication"])
-def change_mode(drone_mode: DroneMode):
+async def change_mode(drone_mode: DroneMode):
     """
     Change the flight mode of the drone.
     """
-    global mav_connection
-    if not mav_connection:
+    mav = app.state.mav
+    if not mav:
         raise HTTPException(status_code=500, detail="No MAVLink connection established.")
     
     try:
         # Set the mode using the MAVLink protocol
-        mode_id = mav_connection.mode_mapping()[drone_mode.mode_name]
-        mav_connection.set_mode(mode_id)
+        mode_id = app.state.mode_map[drone_mode.mode_name]
+        await run_blocking(mav.set_mode, mode_id)
         return {"message": f"Flight mode changed to '{drone_mode.mode_name}'"}
     except KeyError:
         raise HTTPException(status_code=400, detail=f"Invalid mode: '{drone_mode.mode_name}'")
@@ -93,38 +464,33 @@ def change_mode(drone_mode: DroneMode):
         raise HTTPException(status_code=500, detail=f"Error changing mode: {e}")
 
 @app.post("/send_command", tags=["Communication"])
-def send_command(command: str):
+async def send_command(command: DroneCommand):
     """
     Send a command to the drone via the MAVLink connection.
     """
-    global mav_connection
-    if not mav_connection:
+    command_long = app.state.command_long
+    if not command_long:
         raise HTTPException(status_code=500, detail="No active connection. Please connect first.")
     
     try:
         # Send the custom MAVLink command if supported
-        mav_connection.mav.command_long_send(
-            mav_connection.target_system,
-            mav_connection.target_component,
+        await run_blocking(
+            command_long,
             mavutil.mavlink.MAV_CMD_DO_SET_MODE,
-            0,  # Confirmation
-            command,
+            command.confirmation,
+            command.mode_id,
             0, 0, 0, 0, 0, 0
         )
-        return {"message": f"Command '{command}' sent successfully"}
+        return {"message": f"Command '{command.mode_id}' sent successfully"}
     
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error sending command: {e}")
 
 @app.post("/disconnect_drone", tags=["Communication"])
-def disconnect_drone():
+async def disconnect_drone():
     """
     Close the connection to the drone.
     """
-    global ser, mav_connection
-    if ser and ser.is_open:
-        ser.close()
-    if mav_connection:
-        mav_connection.close()
-        mav_connection = None
+    async with app.state.lock:
+        await close_drone_connection()
     return {"message": "Connection closed successfully"}